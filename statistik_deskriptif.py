@@ -1,15 +1,15 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
 import io
-import base64
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from docx import Document
-from docx.shared import Inches
-import tempfile
-import os
+import hashlib
+import textwrap
+import threading
+import weakref
+from functools import partial
 
 # Set page configuration
 st.set_page_config(
@@ -29,12 +29,23 @@ uploaded_file = st.file_uploader("Choose a CSV or Excel file", type=["csv", "xls
 # Initialize dataframe
 df = None
 
+# The chart builders below are cached. The frame is passed as _data so
+# Streamlit does not hash it; data_key (upload digest plus the selected drugs)
+# identifies it exactly instead.
+
 # Function to create time series plot
-def create_time_series_plot(df, selected_drugs):
-    fig, ax = plt.subplots(figsize=(12, 6))
+@st.cache_resource(max_entries=32)
+def create_time_series_plot(_data, data_key):
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    
+    # Downsample very long series; the dropped points are not visible on screen
+    plot_data = _data
+    if len(plot_data) > 10000:
+        plot_data = plot_data.iloc[::max(1, len(plot_data) // 5000)]
     
-    for drug in selected_drugs:
-        ax.plot(df.index, df[drug], label=drug)
+    # Plot all selected drugs in a single call
+    plot_data.plot(ax=ax)
     
     ax.set_xlabel('Date')
     ax.set_ylabel('Sales Volume')
@@ -42,63 +53,132 @@ def create_time_series_plot(df, selected_drugs):
     ax.legend()
     ax.grid(True, alpha=0.3)
     
-    plt.tight_layout()
+    fig.tight_layout()
     return fig
 
 # Function to create boxplot
-def create_boxplot(df, selected_drugs):
-    fig, ax = plt.subplots(figsize=(12, 6))
+@st.cache_resource(max_entries=32)
+def create_boxplot(_data, data_key):
+    import seaborn as sns
     
-    # Reshape data for boxplot
-    plot_data = df[selected_drugs].melt(var_name='Drug Category', value_name='Sales Volume')
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
     
-    # Create boxplot
-    sns.boxplot(x='Drug Category', y='Sales Volume', data=plot_data, ax=ax)
+    # Create boxplot from wide-form data (one box per column)
+    sns.boxplot(data=_data, ax=ax)
     
     ax.set_xlabel('Drug Category')
     ax.set_ylabel('Sales Volume')
     ax.set_title('Distribution of Drug Sales Volume by Category')
-    plt.xticks(rotation=45)
+    ax.tick_params(axis='x', rotation=45)
     
-    plt.tight_layout()
+    fig.tight_layout()
     return fig
 
+# Function to calculate a correlation matrix
+def compute_correlation(data):
+    # pandas handles missing values pairwise, so only take the fast path for complete data
+    if data.isna().to_numpy().any():
+        return data.corr()
+    
+    # Standardise each column and correlate with a single matrix product
+    arr = np.array(data.to_numpy(dtype=np.float32), order='C')  # contiguous, writable copy
+    # Constant columns have no correlation; detect them on the raw values, since
+    # float32 centring can leave a tiny nonzero residue instead of exact zeros
+    constant = np.ptp(arr, axis=0) == 0
+    arr -= arr.mean(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        arr /= arr.std(0)
+        corr = (arr.T @ arr) / len(arr)
+    corr[constant, :] = np.nan
+    corr[:, constant] = np.nan
+    # Keep float32 rounding from pushing values just past +/-1
+    np.clip(corr, -1, 1, out=corr)
+    return pd.DataFrame(corr, index=data.columns, columns=data.columns)
+
 # Function to create heatmap
-def create_heatmap(df, selected_drugs):
+@st.cache_resource(max_entries=32)
+def create_heatmap(_data, data_key):
     # Calculate correlation matrix
-    corr_matrix = df[selected_drugs].corr()
+    corr_matrix = compute_correlation(_data)
+    arr = corr_matrix.to_numpy()
+    labels = list(corr_matrix.columns)
     
-    # Create heatmap
-    fig, ax = plt.subplots(figsize=(10, 8))
-    sns.heatmap(corr_matrix, annot=True, cmap='coolwarm', ax=ax, fmt=".2f", linewidths=0.5)
+    # Create heatmap as a single image with the values written on top
+    fig = Figure(figsize=(10, 8))
+    ax = fig.subplots()
+    im = ax.imshow(arr, cmap='coolwarm', vmin=-1, vmax=1)
+    fig.colorbar(im, ax=ax)
+    ax.set_xticks(range(len(labels)))
+    ax.set_xticklabels(labels, rotation=45)
+    ax.set_yticks(range(len(labels)))
+    ax.set_yticklabels(labels)
+    for (i, j), value in np.ndenumerate(arr):
+        ax.text(j, i, f"{value:.2f}", ha='center', va='center', fontsize=8,
+                color='white' if abs(value) > 0.5 else 'black')
     ax.set_title('Correlation Between Drug Sales Categories')
     
-    plt.tight_layout()
+    fig.tight_layout()
     return fig
 
+# Function to sum sales per year (cached separately from the chart)
+@st.cache_data(show_spinner=False)
+def compute_yearly_sales(_data, data_key):
+    # Group the selected drug columns directly on the index year; the index is
+    # sorted on load, so the groups already come out in year order
+    return _data.groupby(_data.index.year, sort=False).sum()
+
 # Function to create bar chart of annual sales
-def create_annual_sales(df, selected_drugs):
-    # Create a copy of the dataframe with a year column
-    df_yearly = df.copy()
-    df_yearly['Year'] = df_yearly.index.year
-    
-    # Group by year and sum
-    yearly_sales = df_yearly.groupby('Year')[selected_drugs].sum()
+@st.cache_resource(max_entries=32)
+def create_annual_sales(_data, data_key):
+    yearly_sales = compute_yearly_sales(_data, data_key)
     
     # Create bar chart
-    fig, ax = plt.subplots(figsize=(12, 6))
-    yearly_sales[selected_drugs].plot(kind='bar', ax=ax)
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    yearly_sales.plot(kind='bar', ax=ax)
     
     ax.set_xlabel('Year')
     ax.set_ylabel('Total Sales Volume')
     ax.set_title('Annual Drug Sales by Category')
     ax.legend(title='Drug Category')
     
-    plt.tight_layout()
+    fig.tight_layout()
     return fig
 
+# Function to hold rendered PNGs per figure (shared across reruns, dropped with the figure)
+@st.cache_resource
+def _png_store():
+    # The store lock only guards the dictionary itself; each figure gets its own
+    # render lock below
+    return threading.Lock(), weakref.WeakKeyDictionary()
+
+# Function to render a figure to PNG bytes (memoized so both reports share one render).
+# png_store is the (lock, store) pair from _png_store(), fetched in the script
+# thread because report downloads render on a worker thread without a script context
+def _render_png(png_store, fig, dpi=150):
+    store_lock, store = png_store
+    with store_lock:
+        fig_lock, renders = store.setdefault(fig, (threading.Lock(), {}))
+    
+    # Report downloads are built on their own threads and a figure must not be
+    # drawn from two threads at once, so renders of the same figure take turns
+    with fig_lock:
+        if dpi not in renders:
+            buf = io.BytesIO()
+            # Charts already call tight_layout, so skip the extra bbox_inches='tight' render pass
+            fig.savefig(buf, format='png', dpi=dpi,
+                        pil_kwargs={'compress_level': 6})
+            renders[dpi] = buf.getvalue()
+        return renders[dpi]
+
 # Function to create a PDF report
-def create_pdf_report(fig, description):
+def create_pdf_report(png_bytes, description):
+    # Imported here so the PDF dependency only loads when a report is built
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+    
     buffer = io.BytesIO()
     c = canvas.Canvas(buffer, pagesize=letter)
     width, height = letter
@@ -116,103 +196,146 @@ def create_pdf_report(fig, description):
     text_object.setFont("Helvetica", 10)
     
     # Split description into lines
-    words = description.split()
-    lines = []
-    line = ""
-    for word in words:
-        if len(line + word) + 1 <= 80:  # Limit line length
-            line += word + " "
-        else:
-            lines.append(line)
-            line = word + " "
-    if line:
-        lines.append(line)
-    
-    for line in lines:
-        text_object.textLine(line)
+    lines = textwrap.wrap(description, width=80)  # Limit line length
+    text_object.textLines("\n".join(lines))
     
     c.drawText(text_object)
     
-    # Save figure to temporary file
-    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
-        temp_filename = tmp_file.name
-        fig.savefig(temp_filename, format='png', dpi=300, bbox_inches='tight')
-    
-    # Add figure to PDF
-    c.drawImage(temp_filename, 72, 100, width=width-144, height=height-300)
+    # Add figure to PDF straight from memory
+    c.drawImage(ImageReader(io.BytesIO(png_bytes)), 72, 100, width=width-144, height=height-300)
     
     c.save()
-    os.unlink(temp_filename)  # Remove temporary file
     
     buffer.seek(0)
     return buffer
 
 # Function to create a Word document report
-def create_word_report(fig, description):
+def create_word_report(png_bytes, description):
+    # Imported here so the Word dependency only loads when a report is built
+    from docx import Document
+    from docx.shared import Inches
+    
     doc = Document()
     doc.add_heading('Drug Sales Data Visualization Report', 0)
     
     doc.add_heading('Description:', level=1)
     doc.add_paragraph(description)
     
-    # Save figure to temporary file
-    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
-        temp_filename = tmp_file.name
-        fig.savefig(temp_filename, format='png', dpi=300, bbox_inches='tight')
-    
-    # Add figure to Word document
+    # Add figure to Word document straight from memory
     doc.add_heading('Visualization:', level=1)
-    doc.add_picture(temp_filename, width=Inches(6))
+    doc.add_picture(io.BytesIO(png_bytes), width=Inches(6))
     
     # Save the document to a BytesIO object
     buffer = io.BytesIO()
     doc.save(buffer)
-    os.unlink(temp_filename)  # Remove temporary file
     
     buffer.seek(0)
     return buffer
 
-# Function to create download link
-def get_download_link(buffer, download_filename, link_text):
-    b64 = base64.b64encode(buffer.getvalue()).decode()
-    return f'<a href="data:application/octet-stream;base64,{b64}" download="{download_filename}">{link_text}</a>'
+# Function to build a report from a figure on demand
+def build_report(create_report, png_store, fig, description):
+    return create_report(_render_png(png_store, fig), description).getvalue()
+
+# Function to show the download section; as a fragment, clicking a download
+# reruns only this section instead of the whole script
+@st.fragment
+def show_downloads(fig, description):
+    st.header("4. Download Report")
+    col1, col2 = st.columns(2)
+    png_store = _png_store()
+    
+    # Reports are only built when the matching button is clicked
+    with col1:
+        st.download_button(
+            "Download PDF Report",
+            data=partial(build_report, create_pdf_report, png_store, fig, description),
+            file_name="drug_sales_report.pdf",
+            mime="application/pdf"
+        )
+    
+    with col2:
+        st.download_button(
+            "Download Word Report",
+            data=partial(build_report, create_word_report, png_store, fig, description),
+            file_name="drug_sales_report.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+        )
+
+# Function to drop the stored chart so it is no longer shown or downloadable
+def clear_generated_chart():
+    st.session_state.pop('fig', None)
+    st.session_state.pop('chart_key', None)
+
+# Function to pick the date column from a list of column names
+def find_date_column(columns):
+    # Check if 'datum' column exists (date column)
+    if 'datum' in columns:
+        return 'datum'
+    elif 'date' in columns:
+        return 'date'
+    # If no date column found, assume first column might be date
+    return columns[0]
+
+# Function to load and parse the uploaded file (cached across reruns)
+@st.cache_data(show_spinner=False)
+def load_dataframe(file_bytes, filename):
+    # Check file type
+    if filename.endswith('.csv'):
+        # Peek at the header to find the date column, then parse it while reading
+        date_column = find_date_column(pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns)
+        df = pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow', parse_dates=[date_column])
+    else:  # Excel file
+        try:
+            # calamine parses workbooks much faster than openpyxl
+            df = pd.read_excel(io.BytesIO(file_bytes), engine='calamine')
+        except (ImportError, ValueError):
+            # Fall back to the default engine (openpyxl, or xlrd for .xls)
+            df = pd.read_excel(io.BytesIO(file_bytes))
+        date_column = find_date_column(df.columns)
+    
+    # Convert to datetime if the reader did not already parse it
+    if not pd.api.types.is_datetime64_any_dtype(df[date_column]):
+        df[date_column] = pd.to_datetime(df[date_column], cache=True)
+    
+    # Set the date column as index
+    df.set_index(date_column, inplace=True)
+    
+    # Keep rows in date order so later per-year grouping sees contiguous keys
+    if not df.index.is_monotonic_increasing:
+        df.sort_index(inplace=True)
+    
+    # Sales volumes fit comfortably in 32-bit types, which halves memory use;
+    # integer counts stay integers so the preview and yearly totals remain exact
+    int32 = np.iinfo(np.int32)
+    for column in df.select_dtypes('integer').columns:
+        if int32.min <= df[column].min() and df[column].max() <= int32.max:
+            df[column] = df[column].astype('int32')
+    float_cols = df.select_dtypes('floating').columns
+    df[float_cols] = df[float_cols].astype('float32')
+    
+    # Get drug categories (all columns except date column)
+    drug_categories = list(df.columns)
+    return df, drug_categories
 
 # Process uploaded file
 if uploaded_file is not None:
     try:
-        # Check file type
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file)
-        else:  # Excel file
-            df = pd.read_excel(uploaded_file)
+        file_bytes = uploaded_file.getvalue()
+        file_digest = hashlib.sha1(file_bytes).hexdigest()
         
-        # Display raw data sample
-        st.subheader("Data Preview")
-        st.dataframe(df.head())
+        # Forget any chart generated from a previously uploaded file
+        if st.session_state.get('file_digest') != file_digest:
+            clear_generated_chart()
+            st.session_state.file_digest = file_digest
         
-        # Check if 'datum' column exists (date column)
-        date_column = None
-        if 'datum' in df.columns:
-            date_column = 'datum'
-        elif 'date' in df.columns:
-            date_column = 'date'
+        df, drug_categories = load_dataframe(file_bytes, uploaded_file.name)
         
-        # If date column exists, set it as index
-        if date_column:
-            # Convert to datetime
-            df[date_column] = pd.to_datetime(df[date_column])
-            df.set_index(date_column, inplace=True)
+        # Display data sample
+        st.subheader("Data Preview")
+        st.dataframe(df.head())
         
-        # Get drug categories (all columns except date column)
-        if date_column:
-            drug_categories = list(df.columns)
-        else:
-            # If no date column found, assume first column might be date
+        if df.index.name not in ('datum', 'date'):
             st.warning("No explicit date column found. Assuming first column is for dates.")
-            date_column = df.columns[0]
-            df[date_column] = pd.to_datetime(df[date_column])
-            df.set_index(date_column, inplace=True)
-            drug_categories = list(df.columns)
         
         # Visualization options section
         st.header("2. Create Visualization")
@@ -243,40 +366,39 @@ if uploaded_file is not None:
         # Create visualization button
         if st.button("Generate Visualization"):
             if not selected_drugs:
+                clear_generated_chart()
                 st.error("Please select at least one drug category.")
             else:
-                st.subheader("3. Generated Visualization")
+                # Select the drug columns once for whichever chart is drawn
+                sub = df[selected_drugs]
+                data_key = (file_digest, tuple(selected_drugs))
                 
                 # Create appropriate chart based on selection
                 if chart_type == "Time Series":
-                    fig = create_time_series_plot(df, selected_drugs)
+                    fig = create_time_series_plot(sub, data_key)
                 elif chart_type == "Box Plot":
-                    fig = create_boxplot(df, selected_drugs)
+                    fig = create_boxplot(sub, data_key)
                 elif chart_type == "Correlation Heatmap":
-                    fig = create_heatmap(df, selected_drugs)
+                    fig = create_heatmap(sub, data_key)
                 elif chart_type == "Annual Sales":
-                    fig = create_annual_sales(df, selected_drugs)
-                
-                # Display chart
-                st.pyplot(fig)
-                
-                # Download options
-                st.header("4. Download Report")
-                col1, col2 = st.columns(2)
+                    fig = create_annual_sales(sub, data_key)
                 
-                # Create PDF buffer
-                pdf_buffer = create_pdf_report(fig, graph_description)
-                pdf_link = get_download_link(pdf_buffer, "drug_sales_report.pdf", "Download PDF Report")
-                
-                # Create Word buffer
-                docx_buffer = create_word_report(fig, graph_description)
-                docx_link = get_download_link(docx_buffer, "drug_sales_report.docx", "Download Word Report")
-                
-                with col1:
-                    st.markdown(pdf_link, unsafe_allow_html=True)
-                
-                with col2:
-                    st.markdown(docx_link, unsafe_allow_html=True)
+                # Keep the chart, and the inputs it was built from, so it survives
+                # the reruns triggered by the download buttons
+                st.session_state.fig = fig
+                st.session_state.chart_key = (file_digest, chart_type, tuple(selected_drugs))
+        
+        # Only show the stored chart while the widgets still match its inputs
+        if st.session_state.get('chart_key') == (file_digest, chart_type, tuple(selected_drugs)):
+            fig = st.session_state.fig
+            
+            st.subheader("3. Generated Visualization")
+            
+            # Display chart (screen preview only needs a low DPI)
+            st.image(_render_png(_png_store(), fig, dpi=100))
+            
+            # Download options
+            show_downloads(fig, graph_description)
                 
     except Exception as e:
         st.error(f"Error processing file: {e}")